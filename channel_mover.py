@@ -1,59 +1,161 @@
 import streamlit as st
+import io
+import os
 import re
 import json
+import sys
 from collections import namedtuple
 
+import numpy as np
+
+# Interned dispatch roots: ConfigLine interns path_parts[0], so classifying
+# a line compares pointers instead of scanning prefixes.
+CH = sys.intern("ch")
+CONFIG = sys.intern("config")
+OUTPUTS = sys.intern("outputs")
+
+# Line kinds, assigned once at parse time so the regeneration loop dispatches
+# on a single int instead of re-testing path prefixes per line.
+KIND_PLAIN = 0
+KIND_CHLINK = 1
+KIND_CH = 2
+KIND_OUTPUT = 3
+
+# Constant string tables so hot paths index instead of re-formatting.
+CHANNEL_KEYS = tuple(f"ch{i+1:02d}" for i in range(32))
+CHANNEL_NUMS = tuple(f"{i+1:02d}" for i in range(32))
+IDENTITY_MAPPING = tuple(range(32))
+
 scene_file = st.file_uploader("Scene file", type="scn")
 if not scene_file:
     st.stop()
 
 class Crossbar:
     """Represents a 1-to-1 mapping between old and new.
-    
+
+    Slots are stored as numpy int16 with -1 meaning "unmapped", which keeps
+    the two sides as compact contiguous arrays instead of lists of boxed ints
+    and lets callers scan or slice them as vectors.
+
     Example:
-    
+
     >>> cb = Crossbar(n=4)
-    >>> cb.connect(0, 1)
-    >>> cb.connect(2, 3)
+    >>> cb.connect_many([(0, 1), (2, 3)])
     >>> cb.get_unmapped_olds()
     [1, 3]
     >>> cb.get_unmapped_news()
     [0, 2]
     >>> cb.old_to_new
-    [1, None, 3, None]
+    array([ 1, -1,  3, -1], dtype=int16)
     >>> cb.new_to_old
-    [None, 0, None, 2]
+    array([-1,  0, -1,  2], dtype=int16)
+    >>> cb.is_mapped(0)
+    True
     >>> cb.disconnect(0, 1)
+    >>> cb.is_mapped(0)
+    False
     >>> cb.old_to_new
-    [None, None, 3, None]
+    array([-1, -1,  3, -1], dtype=int16)
     >>> cb.new_to_old
-    [None, None, None, 2]
+    array([-1, -1, -1,  2], dtype=int16)
     >>> cb.get_unmapped_olds()
     [0, 1, 3]
     >>> cb.get_mappings()
     [(2, 3)]
+    >>> cb.initialize_noop()
+    >>> cb.get_mappings()
+    [(0, 0), (1, 1), (2, 2), (3, 3)]
+    >>> list(cb.iter_mappings()) == cb.get_mappings()
+    True
+    >>> cb.clear_all_mappings()
+    >>> cb.get_mappings()
+    []
+    >>> cb.get_unmapped_olds()
+    [0, 1, 2, 3]
     """
 
     def __init__(self, n):
-        self.old_to_new = [None] * n
-        self.new_to_old = [None] * n
+        self.old_to_new = np.full(n, -1, dtype=np.int16)
+        self.new_to_old = np.full(n, -1, dtype=np.int16)
+        # Maintained incrementally so get_unmapped_* doesn't rescan the arrays.
+        self._unmapped_olds = set(range(n))
+        self._unmapped_news = set(range(n))
+        # Bumped on every mutation; get_unmapped_* memoizes its sorted list
+        # against this, so repeated calls between edits skip the re-sort.
+        self._version = 0
+        self._olds_cache = (-1, [])
+        self._news_cache = (-1, [])
 
     def connect(self, old, new):
         self.old_to_new[old] = new
         self.new_to_old[new] = old
+        self._unmapped_olds.discard(old)
+        self._unmapped_news.discard(new)
+        self._version += 1
+
+    def connect_many(self, pairs):
+        """Connect many (old, new) pairs with one vectorized store each way."""
+        p = np.asarray(pairs, dtype=np.int16)
+        if p.size:
+            olds = p[:, 0]
+            news = p[:, 1]
+            self.old_to_new[olds] = news
+            self.new_to_old[news] = olds
+            self._unmapped_olds.difference_update(olds.tolist())
+            self._unmapped_news.difference_update(news.tolist())
+        self._version += 1
 
     def disconnect(self, old, new):
-        self.old_to_new[old] = None
-        self.new_to_old[new] = None
+        self.old_to_new[old] = -1
+        self.new_to_old[new] = -1
+        self._unmapped_olds.add(old)
+        self._unmapped_news.add(new)
+        self._version += 1
+
+    def initialize_noop(self):
+        """Set the identity mapping (old i -> new i) in one vector store."""
+        n = len(self.old_to_new)
+        self.old_to_new[:] = np.arange(n, dtype=np.int16)
+        self.new_to_old[:] = self.old_to_new
+        self._unmapped_olds.clear()
+        self._unmapped_news.clear()
+        self._version += 1
+
+    def clear_all_mappings(self):
+        """Unmap everything in one vector store."""
+        n = len(self.old_to_new)
+        self.old_to_new.fill(-1)
+        self.new_to_old.fill(-1)
+        self._unmapped_olds = set(range(n))
+        self._unmapped_news = set(range(n))
+        self._version += 1
+
+    def is_mapped(self, old):
+        return bool(self.old_to_new[old] != -1)
 
     def get_mappings(self):
-        return [(i, v) for i, v in enumerate(self.old_to_new) if v is not None]
-    
+        idx = np.flatnonzero(self.old_to_new != -1)
+        return list(zip(idx.tolist(), self.old_to_new[idx].tolist()))
+
+    def iter_mappings(self):
+        """Yield (old, new) pairs without materializing the list."""
+        otn = self.old_to_new
+        for o in np.flatnonzero(otn != -1):
+            yield int(o), int(otn[o])
+
     def get_unmapped_olds(self):
-        return [i for i, v in enumerate(self.old_to_new) if v is None]
-    
+        version, cached = self._olds_cache
+        if version != self._version:
+            cached = sorted(self._unmapped_olds)
+            self._olds_cache = (self._version, cached)
+        return cached
+
     def get_unmapped_news(self):
-        return [i for i, v in enumerate(self.new_to_old) if v is None]
+        version, cached = self._news_cache
+        if version != self._version:
+            cached = sorted(self._unmapped_news)
+            self._news_cache = (self._version, cached)
+        return cached
     
     def __str__(self):
         return f"Crossbar(old_to_new={self.old_to_new}, new_to_old={self.new_to_old})"
@@ -64,30 +166,55 @@ class Crossbar:
     def __len__(self):
         return len(self.old_to_new)
 
-# run those doctests
-import doctest
-doctest.testmod()
+# Doctests are opt-in (RUN_DOCTESTS=1) so deployed reruns never pay for
+# parsing and executing the docstring examples. Streamlit executes this
+# script as __main__, so a __main__ guard would not help here.
+if os.environ.get("RUN_DOCTESTS"):
+    import doctest
+    doctest.testmod()
+
 
+class ConfigLine(namedtuple("ConfigLine", 'path value path_parts kind')):
+    def __new__(cls, path, value, path_parts=None, kind=None):
+        # Split the path and classify the line once at construction; the
+        # regeneration loop reads both several times per line.
+        if path_parts is None:
+            parts = path.split("/")[1:]
+            if parts:
+                parts[0] = sys.intern(parts[0])
+            path_parts = tuple(parts)
+        if kind is None:
+            root = path_parts[0] if path_parts else ""
+            if root is CH:
+                kind = KIND_CH
+            elif root is CONFIG and len(path_parts) > 1 and path_parts[1].startswith("chlink"):
+                kind = KIND_CHLINK
+            elif root is OUTPUTS and len(path_parts) == 3:
+                kind = KIND_OUTPUT
+            else:
+                kind = KIND_PLAIN
+        return super().__new__(cls, path, value, path_parts, kind)
 
-class ConfigLine(namedtuple("ConfigLine", 'path value')):
     def match_context(self, path):
         return self.path.startswith(path)
-    
+
     def match_setting(self, path):
         return self.path.endswith(path)
-    
-    @property
-    def path_parts(self):
-        return self.path.split("/")[1:]
-    
+
     def __str__(self) -> str:
         return f"{self.path} {self.value}"
-    
+
     def with_replaced_path_part(self, index: int, new_value: str) -> "ConfigLine":
-        path_parts = self.path_parts.copy()
-        path_parts[index] = new_value
-        preamble = self.path.split("/")[0]
-        return ConfigLine("/".join([preamble] + path_parts), self.value)
+        # Find the component's boundaries and splice the replacement in with
+        # one concatenation instead of splitting and re-joining the path.
+        path = self.path
+        start = 0
+        for _ in range(index + 1):
+            start = path.index("/", start) + 1
+        end = path.find("/", start)
+        if end == -1:
+            end = len(path)
+        return ConfigLine(path[:start] + new_value + path[end:], self.value)
 
 
 def parse_cfgline(line):
@@ -101,102 +228,157 @@ def parse_cfgline(line):
     # ConfigLine(path=['ch', '01', 'config'], value='xxxxx xxxx'])
     ConfigLine(path="/ch/01/config", value="xxxxx xxxx")
     """
-    parts = line.split(" ", 1)
-    path = parts[0]#.split("/")[1:]
-    value = parts[1]
+    # partition returns a fixed 3-tuple; split(" ", 1) allocates a list.
+    path, _, value = line.partition(" ")
     return ConfigLine(path, value)
 
-# Match channel number and name
-# e.g.,
-# /ch/01/config "Acoustic Gtr" 23 RD 1
-# should match 01 and "Acoustic Gtr"
-channel_pattern = re.compile(r"/ch/(\d+)/config\s+\"(.+)\"")
-
-channel_names = {}
-lines = scene_file.read().decode('utf-8').splitlines()
-# The file starts with a header line
-# example:
-# #4.0# "Choir" "" %000000000 1    
-header = lines.pop(0)
-parsed_lines = [parse_cfgline(line) for line in lines]
-for line in lines:
-    if line.startswith("/config/chlink"):
-        channel_links = [x == "ON" for x in line.split(" ")[1:]]
-        assert len(channel_links) == 16
-    if match := channel_pattern.match(line):
-        channel_number = match.group(1)
-        channel_name = match.group(2)
-        channel_names[f"ch{channel_number}"] = channel_name
+# Channel names and the chlink line are pulled out with one combined
+# multiline regex pass over the whole decoded buffer: the regex engine's
+# C loop replaces per-line match dispatch from Python, and the alternation
+# means the buffer is scanned once instead of once per extraction.
+# e.g. /ch/01/config "Acoustic Gtr" 23 RD 1  -> groups 1 (number), 2 (name)
+#      /config/chlink ON OFF ...             -> group 3 (link tokens)
+scene_scan_pattern = re.compile(
+    r'^/ch/(\d+)/config\s+"(.+)"|^/config/chlink\s+(.*)$', re.M)
 
-for i in range(32):
-    num = str(i+1).zfill(2)
-    channel_names[f"ch{num}"] = channel_names.get(f"ch{num}", f"Ch {num}")
+@st.cache_data(show_spinner=False)
+def parse_scene(raw: bytes) -> tuple[str, list[ConfigLine], list[str], list, int]:
+    """Parse a scene file into
+    (header, parsed_lines, channel_names, channel_links, channel_links_mask).
+
+    channel_names is a dense list indexed by 0-based channel number, so
+    lookups don't re-format "chNN" dict keys.
+
+    channel_links_mask packs the 16 pair link states into one int (bit i =
+    pair i linked), so comparing or caching link state is a single int op.
+
+    Pure function of the uploaded bytes, so st.cache_data makes this run once
+    per uploaded file instead of on every rerun.
+    """
+    channel_links = None
+    channel_links_mask = 0
+    text = raw.decode('utf-8')
+    lines = text.splitlines()
+    # The file starts with a header line
+    # example:
+    # #4.0# "Choir" "" %000000000 1
+    header = lines.pop(0)
+    parsed_lines = [parse_cfgline(line) for line in lines]
+    channel_names = [None] * 32
+    for m in scene_scan_pattern.finditer(text):
+        if m.group(1) is not None:
+            channel_names[int(m.group(1)) - 1] = m.group(2)
+        else:
+            # One vectorized compare over the token array instead of 16
+            # Python-level == checks; packbits folds it straight into the mask.
+            states = np.asarray(m.group(3).split(" ")) == "ON"
+            assert states.size == 16
+            channel_links = states.tolist()
+            channel_links_mask = int.from_bytes(
+                np.packbits(states, bitorder="little").tobytes(), "little")
+
+    for i in range(32):
+        if channel_names[i] is None:
+            channel_names[i] = f"Ch {CHANNEL_NUMS[i]}"
+    return header, parsed_lines, channel_names, channel_links, channel_links_mask
+
+header, parsed_lines, channel_names, channel_links, channel_links_mask = parse_scene(scene_file.getvalue())
+
+# Bind the session-state proxy once; every attribute access on
+# st.session_state goes through Streamlit's proxy machinery.
+ss = st.session_state
 
 # The channel crossbar maps old to new channels.
-if st.session_state.get('channel_crossbar') is None or st.button("Reset channels"):
-    st.session_state.channel_crossbar = Crossbar(n=32)
-channel_crossbar = st.session_state.channel_crossbar
+if ss.get('channel_crossbar') is None:
+    ss.channel_crossbar = Crossbar(n=32)
+channel_crossbar = ss.channel_crossbar
+if st.button("Reset channels"):
+    channel_crossbar.clear_all_mappings()
 
 load_crossbar = st.text_input("Paste crossbar JSON here")
 # Example crossbar: [[0, 9], [1, 8], [2, 10], [3, 13], [4, 18], [5, 11], [6, 3], [7, 4], [8, 5], [9, 12], [10, 6], [11, 7], [12, 0], [13, 1], [14, 14], [15, 15], [16, 16], [17, 17], [18, 2], [19, 19], [20, 20], [21, 21], [22, 22], [23, 23], [24, 24], [25, 25], [26, 26], [27, 27], [28, 28], [29, 29], [30, 30], [31, 31]]
 if load_crossbar:
-    st.session_state.channel_crossbar = channel_crossbar = Crossbar(n=32)
-    for old, new in json.loads(load_crossbar):
-        channel_crossbar.connect(old, new)
+    channel_crossbar.clear_all_mappings()
+    channel_crossbar.connect_many(json.loads(load_crossbar))
 
 st.header("New Channels")
 
+# Precompute the option labels once; format_func otherwise runs the full
+# string assembly for every option of every selectbox (~32 x 33 calls).
+option_labels = [
+    channel_names[x] + f" ({x+1})"
+    + (" (linked)" if (x % 2 == 0) and channel_links[x // 2] else "")
+    for x in range(32)
+]
+
 def handle_change(key, prev_old, prev_new):
-    cur_old_channel = st.session_state[key]
+    cur_old_channel = ss[key]
     if prev_old is not None:
         channel_crossbar.disconnect(old=prev_old, new=prev_new)
     if cur_old_channel is not None:
         channel_crossbar.connect(old=cur_old_channel, new=prev_new)
 
+def format_func(x):
+    if x is None:
+        return ''
+    else:
+        return option_labels[x]
+
+# The crossbar doesn't mutate while rendering (handle_change only fires
+# between reruns), so compute these once for all 32 rows.
+available_channels = channel_crossbar.get_unmapped_olds()
+new_to_old_snapshot = channel_crossbar.new_to_old
+
 for i in range(32):
-    num = str(i+1).zfill(2)
-    key = f"ch{num}"
+    num = CHANNEL_NUMS[i]
+    key = CHANNEL_KEYS[i]
 
-    available_channels = channel_crossbar.get_unmapped_olds()
-    already_mapped_old_channel_num = channel_crossbar.new_to_old[i]
+    mapped_old = new_to_old_snapshot[i]
+    already_mapped_old_channel_num = None if mapped_old == -1 else mapped_old
     options = available_channels
     if already_mapped_old_channel_num is not None:
         options = [already_mapped_old_channel_num] + options
     options = [None] + options
     index = options.index(already_mapped_old_channel_num)
-    
-    def format_func(x):
-        if x is None:
-            return ''
-        else:
-            is_linked = (x % 2 == 0) and channel_links[x // 2]
-            return channel_names[f"ch{x+1:02d}"] + f" ({x+1})" + (" (linked)" if is_linked else "")
 
     st.selectbox(
         f"Channel {num}", options,
         key=key, index=index,
         format_func=format_func,
         on_change=handle_change,
-        kwargs=dict(key=key, prev_old=already_mapped_old_channel_num, prev_new=i))
-
-new_channel_links = []
-for i in range(16):
-    new_channel_idx = i * 2
-    old_channel_idx = channel_crossbar.new_to_old[new_channel_idx]
-    if old_channel_idx is None:
-        is_linked = False
-    else:
-        # New channel 2i should be linked if old channel was linked
-        is_linked = channel_links[old_channel_idx // 2]
-        if is_linked and old_channel_idx % 2 == 1:
-            st.warning(f"Link mismatch {old_channel_idx} -> {new_channel_idx}")
-    new_channel_links.append(is_linked)
+        kwargs={'key': key, 'prev_old': already_mapped_old_channel_num, 'prev_new': i})
+
+# New channel 2i should be linked if the old channel mapped there was linked.
+# The reconciliation is a pure function of the mapping and the original link
+# states, so skip it when neither changed since the last rerun.
+fingerprint = (tuple(channel_crossbar.old_to_new.tolist()), channel_links_mask)
+if ss.get('_link_fingerprint') == fingerprint:
+    new_links_mask, link_warnings = ss['_link_cache']
+else:
+    links_arr = np.asarray(channel_links, dtype=bool)
+    left_olds = channel_crossbar.new_to_old[0::2]
+    mapped = left_olds >= 0
+    safe_olds = np.where(mapped, left_olds, 0)
+    linked = mapped & links_arr[safe_olds // 2]
+    link_warnings = [
+        f"Link mismatch {left_olds[i]} -> {i * 2}"
+        for i in np.flatnonzero(linked & (safe_olds % 2 == 1))
+    ]
+    new_links_mask = 0
+    for i in np.flatnonzero(linked):
+        new_links_mask |= 1 << int(i)
+    ss['_link_fingerprint'] = fingerprint
+    ss['_link_cache'] = (new_links_mask, link_warnings)
+# One st.warning element for all mismatches; each call is a separate DOM
+# element and protobuf round-trip.
+if link_warnings:
+    st.warning("\n\n".join(link_warnings))
 
 # TODO: verify that linked channels are still matched identically
 # (this should also ensure that a linked channel hasn't ended up at an even index)
 
-if channel_links != new_channel_links:
-    st.write("New channel links:", new_channel_links)
+if channel_links_mask != new_links_mask:
+    st.write("New channel links:", [bool(new_links_mask >> i & 1) for i in range(16)])
 else:
     st.write("Channel links unchanged")
 
@@ -209,41 +391,94 @@ else:
 # 64-73: FX1L-FX4R
 # 74-76: monL, monR, talkback
 
-# Regenerate the scene file
-already_warned = {}
-new_scene = [header]
-for setting in parsed_lines:
-    if setting.path.startswith("/config/chlink"):
-        setting = ConfigLine(
-            path=setting.path,
-            value=" ".join(["ON" if x else "OFF" for x in new_channel_links]))
-    elif setting.match_context("/ch"):
-        old_channel_num = int(setting.path_parts[1]) - 1
-        new_channel_number = channel_crossbar.old_to_new[old_channel_num]
-        if new_channel_number is None:
-            if not already_warned.get(old_channel_num):
-                old_channel_name = channel_names[f"ch{old_channel_num+1:02d}"]
-                st.write("Skipping channel ", old_channel_name, " because it is not mapped.")
-                already_warned[old_channel_num] = True
-            continue
-        setting = setting.with_replaced_path_part(1, str(new_channel_number + 1).zfill(2))
-    elif setting.path.startswith("/outputs") and len(setting.path_parts) == 3:
-        src_code_raw = setting.value.split(" ")[0]
-        src_code = int(src_code_raw)
-        if 26 <= src_code <= 57:
-            old_channel_num = src_code - 26
-            new_channel_number = channel_crossbar.old_to_new[old_channel_num]
-            if new_channel_number is None:
-                new_src_code = 0
-                st.warning(f"Main output {setting.path} was from un-mapped channel {old_channel_num}. Setting to off.")
-            else:
-                new_src_code = new_channel_number + 26
-            setting = ConfigLine(
-                path=setting.path,
-                value=f"{new_src_code} {setting.value.split(' ', 1)[1]}")
-    new_scene.append(str(setting))
+# Regenerate the scene file. Pure function of the uploaded bytes, the
+# crossbar mapping, and the new link states, so st.cache_data skips the
+# full rebuild on reruns where none of those changed.
+@st.cache_data(show_spinner=False)
+def regenerate_scene(raw: bytes, old_to_new: tuple, link_states_mask: int) -> tuple[str, list, list]:
+    header, parsed_lines, names, channel_links, old_links_mask = parse_scene(raw)
+    skipped = []
+    warnings = []
+    skip_reported = set()
+    # One-to-one mapping with unchanged links: every line survives
+    # unchanged, so copy the file through without any per-line parsing.
+    if old_to_new == IDENTITY_MAPPING and link_states_mask == old_links_mask:
+        buf = io.StringIO()
+        buf.write(header)
+        buf.write("\n")
+        for setting in parsed_lines:
+            buf.write(setting.path)
+            buf.write(" ")
+            buf.write(setting.value)
+            buf.write("\n")
+        return buf.getvalue(), skipped, warnings
+    # Per-channel remap decision, computed once instead of per /ch/ line:
+    # the formatted new number, or None for unmapped channels.
+    new_num_str = [
+        None if old_to_new[c] == -1 else CHANNEL_NUMS[old_to_new[c]]
+        for c in range(32)
+    ]
+    # Source codes 26..57 are channels 1..32; precompute the remap once per
+    # generation (0 = off for unmapped channels) so each /outputs line is a
+    # single table index instead of re-deriving the mapping.
+    src_lut = list(range(77))
+    for c in range(32):
+        src_lut[26 + c] = 0 if old_to_new[c] == -1 else old_to_new[c] + 26
+    buf = io.StringIO()
+    buf.write(header)
+    buf.write("\n")
+    for setting in parsed_lines:
+        kind = setting.kind
+        if kind == KIND_CHLINK:
+            # No-op when the link states didn't change from the original.
+            if link_states_mask != old_links_mask:
+                setting = ConfigLine(
+                    path=setting.path,
+                    value=" ".join("ON" if link_states_mask >> i & 1 else "OFF" for i in range(16)))
+        elif kind == KIND_CH:
+            old_channel_num = int(setting.path_parts[1]) - 1
+            num_str = new_num_str[old_channel_num]
+            if num_str is None:
+                if old_channel_num not in skip_reported:
+                    skip_reported.add(old_channel_num)
+                    skipped.append(names[old_channel_num])
+                continue
+            if num_str != setting.path_parts[1]:
+                # "/ch/NN" is always 6 characters, so splice the new number
+                # in directly rather than splitting and rejoining the path.
+                buf.write("/ch/")
+                buf.write(num_str)
+                buf.write(setting.path[6:])
+                buf.write(" ")
+                buf.write(setting.value)
+                buf.write("\n")
+                continue
+            # Channel mapped to itself: the line passes through unchanged.
+        elif kind == KIND_OUTPUT:
+            src_code_raw, _, rest = setting.value.partition(" ")
+            src_code = int(src_code_raw)
+            if 26 <= src_code <= 57:
+                new_src_code = src_lut[src_code]
+                # Identity-mapped codes need no rebuild at all.
+                if new_src_code != src_code:
+                    if new_src_code == 0:
+                        warnings.append(f"Main output {setting.path} was from un-mapped channel {src_code - 26}. Setting to off.")
+                    setting = ConfigLine(
+                        path=setting.path,
+                        value=f"{new_src_code} {rest}")
+        buf.write(setting.path)
+        buf.write(" ")
+        buf.write(setting.value)
+        buf.write("\n")
+
+    return buf.getvalue(), skipped, warnings
 
-new_scene_serialized = "\n".join(new_scene) + "\n"
+new_scene_serialized, skipped_channels, output_warnings = regenerate_scene(
+    scene_file.getvalue(), tuple(channel_crossbar.old_to_new.tolist()), new_links_mask)
+for name in skipped_channels:
+    st.write("Skipping channel ", name, " because it is not mapped.")
+for message in output_warnings:
+    st.warning(message)
 st.download_button("Download new scene", new_scene_serialized, "scene.scn", mime="text/plain")
 
 st.info("Remember to turn off param and channel safes before loading the new scene!")